@@ -9,6 +9,7 @@ CWD: Path = Path.cwd()
 PACKAGE_PATH: Path = Path(__file__).parent
 REPO_PATH: Path = PACKAGE_PATH.parent.parent
 
+FSYNC: bool = os.environ.get("PODGENAI_FSYNC") == "1"  # Note: Default value is documented in readme.
 GiB = 1024**3
 MAX_CONCURRENT_WORKERS = int(os.environ.get("PODGENAI_OPENAI_MAX_WORKERS", 16))  # Note: Default value is documented in readme.
 assert MAX_CONCURRENT_WORKERS >= 1
@@ -0,0 +1,12 @@
+import hashlib
+
+
+def blake2b(text: str) -> str:
+    """Return the 64-bit BLAKE2b hash of the given string as a hexadecimal string."""
+    data: bytes = text.encode()
+    digest: str = hashlib.blake2b(data, digest_size=8).hexdigest()
+    assert len(digest) == 16
+    return digest
+
+
+hasher = blake2b
@@ -1,21 +1,36 @@
+import functools
+import logging
 import os
+import random
+import re
+import stat
+import tempfile
+import threading
+import time
 from pathlib import Path
 from typing import Optional
 
+import httpx
 import openai
 import pathvalidate
 
 import podgenai.exceptions
-from podgenai.config import PROMPTS
+from podgenai.config import FSYNC, PROMPTS
 from podgenai.util.dotenv_ import load_dotenv
-from podgenai.util.binascii import hasher
+from podgenai.util.binascii import crc32
+from podgenai.util.hashlib import hasher
 from podgenai.util.sys import print_warning
 
 load_dotenv()
+log = logging.getLogger(__name__)
 
 ChatCompletion = openai.types.chat.chat_completion.ChatCompletion
 OpenAI = openai.OpenAI
 
+ENDING_REGEX = re.compile(r"(?:^|[ \n])[Dd]one\.?\Z")  # Matches a completion that is or that ends with an ending, namely "Done", "Done.", "done", or "done.".
+FILE_WRITE_BUFFER_SIZE = 1024**2
+MAX_MEMORY_CACHED_CONTENTS = 256
+MAX_RETRIES = 8  # Note: Retries use exponential backoff with jitter, and are made by the client for connection errors, timeouts, 429 rate limit errors, and 5xx server errors. For a streamed request, the client retries only the opening of the stream, and so its consumption is retried separately.
 MAX_TTS_INPUT_LEN = 4096
 MODELS = {
     "text": "gpt-4-0125-preview",
@@ -25,6 +40,8 @@ MODELS = {
     #   gpt-4 is not used because it is much older in its training data.
     "tts": "tts-1",  # Note: tts-1-hd is twice as expensive, and has a more limited concurrent usage quota resulting in openai.RateLimitError, thereby making it undesirable.
 }
+STREAM_CHUNK_SIZE = 64 * 1024
+TIMEOUT = 300  # Seconds. Note: For a request that is not streamed, it bounds each attempt, and it is kept generous because a long completion is received only after it is fully generated. For a streamed request, it bounds the wait for each chunk.
 TTS_VOICE_MAP = {
     "default": "alloy",
     "default-male": "alloy",  # Supported for experimentation.
@@ -43,21 +60,72 @@ def ensure_openai_key() -> None:
         raise podgenai.exceptions.EnvError("The environment variable OPENAI_API_KEY is unavailable. It can optionally be defined in an .env file.")
 
 
+@functools.lru_cache(maxsize=1)
 def get_openai_client() -> OpenAI:
-    """Return the OpenAI client."""
-    return OpenAI()
+    """Return the shared OpenAI client.
+
+    The client is shared so that its HTTP connection pool is reused across all requests, including across concurrent workers.
+    Transient errors are retried by the client so that a single such error does not fail the generation.
+
+    `EnvError` is raised if the environment variable OPENAI_API_KEY is unavailable. As the client is cached, this check is made only once.
+    """
+    ensure_openai_key()
+    return OpenAI(max_retries=MAX_RETRIES, timeout=TIMEOUT)
 
 
 def get_completion(prompt: str, *, client: Optional[OpenAI] = None) -> ChatCompletion:
     """Return the completion for the given prompt."""
     if not client:
         client = get_openai_client()
-    # print(f"Requesting completion for prompt of length {len(prompt)}.")
+    log.debug("Requesting completion for prompt of length %d.", len(prompt))
     completion = client.chat.completions.create(model=MODELS["text"], messages=[{"role": "user", "content": prompt}])
     # Note: Specifying max_tokens=4096 with gpt-4-turbo-preview did not benefit in increasing output length, and a higher value is disallowed. Ref: https://platform.openai.com/docs/api-reference/chat/create
     return completion
 
 
+def _get_streamed_response_text(text: str, *, client: OpenAI, previous_response_id: Optional[str], description: str) -> tuple[str, str]:
+    """Return the response ID and the output text for the given input text using the streamed Responses API.
+
+    If the output is truncated by the output token limit, the partial output text is returned, thereby allowing it to be continued.
+    A transient failure, namely a connection error, an interrupted stream, or a server error, is retried with the same `previous_response_id`, up to `MAX_RETRIES` times with exponential backoff and jitter.
+    This is necessary because the client retries only the opening of a stream, not its consumption.
+    `LanguageModelOutputError` is raised for any other failure, or if the retries are exhausted.
+    """
+    for num_attempt in range(1, MAX_RETRIES + 2):
+        deltas = []
+        fault = "The stream ended without the response being completed."
+        try:
+            # Note: The response is streamed so that the timeout applies to the wait for each received chunk rather than to the full response. As the client does not retry the consumption of a stream, this function retries it instead.
+            # Note: The stream is not stopped early when an ending is seen in it, as an ending such as "done." can also occur mid-text, with more text following it.
+            # Note: The response is stored by the server, as is necessary for it to be referenced by `previous_response_id`. This is not supported for organizations having zero data retention.
+            with client.responses.create(model=MODELS["text"], input=text, previous_response_id=previous_response_id, store=True, stream=True) as stream:
+                for event in stream:
+                    match event.type:
+                        case "response.output_text.delta":
+                            deltas.append(event.delta)
+                        case "response.completed":
+                            return event.response.id, "".join(deltas)
+                        case "response.incomplete" if event.response.incomplete_details and (event.response.incomplete_details.reason == "max_output_tokens"):
+                            log.debug("The %s is truncated by the output token limit.", description)
+                            return event.response.id, "".join(deltas)
+                        case "response.incomplete":
+                            raise podgenai.exceptions.LanguageModelOutputError(f"The {description} is incomplete: {event.response.incomplete_details}")
+                        case "response.failed" if event.response.error and (event.response.error.code == "server_error"):
+                            fault = f"The response failed with a server error: {event.response.error.message}"
+                            break
+                        case "response.failed":
+                            raise podgenai.exceptions.LanguageModelOutputError(f"The {description} failed: {event.response.error}")
+        except (httpx.TransportError, openai.APIConnectionError) as exc:
+            fault = f"{type(exc).__name__}: {exc}"
+
+        if num_attempt > MAX_RETRIES:
+            raise podgenai.exceptions.LanguageModelOutputError(f"The {description} failed after {num_attempt} attempts: {fault}")
+        print_warning(f"Fault in attempt {num_attempt} of {MAX_RETRIES + 1} for {description}: {fault}")
+        time.sleep(random.uniform(0, min(2**num_attempt, 60)))
+
+    assert False
+
+
 def get_multipart_messages(prompt: str, *, max_completions: int = 10, client: Optional[OpenAI] = None, update_prompt: bool = False, continuation: str = PROMPTS["continuation_next"]) -> list[dict]:
     """Return the multipart completion messages for the given initial prompt.
 
@@ -67,29 +135,29 @@ def get_multipart_messages(prompt: str, *, max_completions: int = 10, client: Op
     If `update_prompt` is False, the initial prompt can be provided with an included continuation note.
 
     If `continuation` is specified, it is used iteratively as the continuation prompt, otherwise a default continuation prompt is used.
+
+    The conversation state is kept by the server using the Responses API, although the full list of messages is also returned.
     """
     if update_prompt:
         prompt = prompt + "\n\n" + PROMPTS["continuation_first"]
-    endings = ("Done", "Done.", "done", "done.")
-
     if not client:
         client = get_openai_client()
 
     messages = [{"role": "user", "content": prompt}]
+    response_id = None
+    # Note: The completions are necessarily requested serially, as each continuation request depends on the preceding completion. They are therefore not speculatively requested in advance.
+    # Note: Concurrency is instead obtained across independent prompts by the callers, e.g. in `get_subtopics_texts`.
     for completion_num in range(1, max_completions + 1):
-        # print(f"Requesting completion {completion_num} for initial prompt of length {len(prompt)}.")
-        completion = client.chat.completions.create(model=MODELS["text"], messages=messages)
-        content = get_content(prompt="", completion=completion)
+        log.debug("Requesting completion %d for initial prompt of length %d.", completion_num, len(prompt))
+        # Note: Only the latest user message is sent, with the prior conversation being referenced by `previous_response_id` as stored by the server. This avoids resending the growing conversation with each continuation.
+        response_id, content = _get_streamed_response_text(messages[-1]["content"], client=client, previous_response_id=response_id, description=f"completion {completion_num} for initial prompt of length {len(prompt)}")
+        content = content.strip()
+        assert content
         messages.append({"role": "assistant", "content": content})
 
-        if content in endings:
-            print(f"Completion {completion_num} is an ending.")
+        if ending_match := ENDING_REGEX.search(content):
+            log.debug("Completion %d %s an ending.", completion_num, "is" if ending_match.start() == 0 else "has")
             return messages
-        else:
-            for ending in endings:
-                if content.endswith((f" {ending}", f"\n{ending}")):
-                    print(f"Completion {completion_num} has an ending.")
-                    return messages
 
         if completion_num == max_completions:
             print_warning(f"The quota of a maximum of {max_completions} completions is exhausted for initial prompt of length {len(prompt)}.")
@@ -117,27 +185,87 @@ def get_multipart_content(prompt: str, **kwargs) -> str:
 
     The completions are joined using paragraph breaks (double line breaks).
     """
-    endings = ("Done", "Done.", "done", "done.")
     messages = get_multipart_messages(prompt, **kwargs)
 
     completions = []
     for message_count, message in enumerate(messages, start=1):
         if message["role"] != "assistant":
             continue
-        completion = message["content"]
-        assert completion == completion.strip()
-        if completion in endings:
-            assert message_count == len(messages), {"prompt": prompt, "messages": messages, "message_count": message_count, "completion": completion}
-            break
-        for ending in endings:
-            if completion.endswith((f" {ending}", f"\n{ending}")):
-                completion = completion.removesuffix(ending).rstrip()
+        completion = message["content"]  # Note: It is already stripped by `get_multipart_messages`.
+        if ending_match := ENDING_REGEX.search(completion):
+            if ending_match.start() == 0:  # Is an ending.
+                assert message_count == len(messages), {"prompt": prompt, "messages": messages, "message_count": message_count, "completion": completion}
                 break
+            completion = completion[: ending_match.start()].rstrip()  # Has an ending.
         completions.append(completion)
 
     return "\n\n".join(completions).strip()
 
 
+@functools.lru_cache(maxsize=1024)
+def _ensure_cache_dir(cache_path: Path) -> None:
+    """Raise `AssertionError` if the given cache directory does not exist.
+
+    The check is cached, and is therefore made only once per cache directory.
+    """
+    assert cache_path.is_dir(), cache_path
+
+
+@functools.lru_cache(maxsize=1024)
+def _sanitize_cache_key_prefix(cache_key_prefix: str) -> str:
+    """Return the filename-sanitized cache key prefix."""
+    sanitized_cache_key_prefix = pathvalidate.sanitize_filename(cache_key_prefix, platform="auto")
+    assert sanitized_cache_key_prefix
+    return sanitized_cache_key_prefix
+
+
+@functools.lru_cache(maxsize=1024)
+def _validate_cache_file_path_template(cache_path: Path, sanitized_cache_key_prefix: str, strategy: str) -> None:
+    """Validate the cache file path for the given cache directory, sanitized cache key prefix, and strategy.
+
+    As the hash in a cache key is always of a fixed length and hexadecimal, it is substituted with zeros for validation, thereby allowing the validation to be cached independently of the prompt.
+    """
+    cache_key = f"{sanitized_cache_key_prefix} ({strategy}) [{'0' * len(hasher(''))}].txt"
+    pathvalidate.validate_filepath(cache_path / cache_key, platform="auto")
+
+
+_memory_cached_contents: dict[Path, str] = {}  # Note: Only the contents of existing cache files are cached in memory, ordered from least to most recently used.
+_memory_cached_contents_lock = threading.Lock()
+
+
+def _read_cache_file(cache_file_path: Path) -> Optional[str]:
+    """Return the content of the given cache file if it exists, otherwise `None`.
+
+    The content of an existing file is cached in memory, keyed by the file path, which includes the prompt hash rather than the prompt. Up to `MAX_MEMORY_CACHED_CONTENTS` contents are cached, with the least recently used being evicted first.
+    A missing file is not cached in memory, and so it is checked on disk each time. The memory cache entry for a file must be evicted using `_evict_memory_cached_content` whenever the file is written.
+    """
+    with _memory_cached_contents_lock:
+        content = _memory_cached_contents.pop(cache_file_path, None)
+        if content is not None:
+            _memory_cached_contents[cache_file_path] = content  # Note: This reinsertion marks the entry as the most recently used.
+    if content is not None:
+        return content
+
+    try:
+        cache_file_stat = os.stat(cache_file_path)  # Note: A single stat call is used to check both existence and type.
+    except FileNotFoundError:
+        return None
+    assert stat.S_ISREG(cache_file_stat.st_mode), cache_file_path
+    content = cache_file_path.read_bytes().decode("utf-8").rstrip()  # rstrip is used in case the file is manually modified in an editor which adds a trailing newline.
+
+    with _memory_cached_contents_lock:
+        _memory_cached_contents[cache_file_path] = content
+        while len(_memory_cached_contents) > MAX_MEMORY_CACHED_CONTENTS:
+            del _memory_cached_contents[next(iter(_memory_cached_contents))]
+    return content
+
+
+def _evict_memory_cached_content(cache_file_path: Path) -> None:
+    """Evict the memory cache entry, if any, for the given cache file."""
+    with _memory_cached_contents_lock:
+        _memory_cached_contents.pop(cache_file_path, None)
+
+
 def get_cached_content(prompt: str, *, strategy: str = "oneshot", read_cache: bool = True, cache_key_prefix: str, cache_path: Path, **kwargs) -> str:
     """Return the content for the given prompt using the disk cache if available, otherwise normally.
 
@@ -153,24 +281,38 @@ def get_cached_content(prompt: str, *, strategy: str = "oneshot", read_cache: bo
     """
     cache_key_prefix = cache_key_prefix.strip()
     assert cache_key_prefix
-    assert cache_path.is_dir()
+    _ensure_cache_dir(cache_path)
 
-    sanitized_cache_key_prefix = pathvalidate.sanitize_filename(cache_key_prefix, platform="auto")
-    assert sanitized_cache_key_prefix
+    sanitized_cache_key_prefix = _sanitize_cache_key_prefix(cache_key_prefix)
+    _validate_cache_file_path_template(cache_path, sanitized_cache_key_prefix, strategy)
     cache_key = f"{sanitized_cache_key_prefix} ({strategy}) [{hasher(prompt)}].txt"
     cache_file_path = cache_path / cache_key
-    pathvalidate.validate_filepath(cache_file_path, platform="auto")
 
-    if read_cache and cache_file_path.exists():
-        assert cache_file_path.is_file()
-        content = cache_file_path.read_text().rstrip()  # rstrip is used in case the file is manually modified in an editor which adds a trailing newline.
-        print(f"Read completion from disk for: {cache_key_prefix}")
-    else:
+    content = None
+    if read_cache:
+        content = _read_cache_file(cache_file_path)
+        if content is None:
+            legacy_cache_file_path = cache_path / f"{sanitized_cache_key_prefix} ({strategy}) [{crc32(prompt)}].txt"
+            if legacy_cache_file_path.exists():  # Note: This migrates a cache file that was written when the CRC32 hash was used for the cache key.
+                legacy_cache_file_path.rename(cache_file_path)
+                content = _read_cache_file(cache_file_path)
+        if content is not None:
+            print(f"Read completion from disk for: {cache_key_prefix}")
+
+    if content is None:
         content_getter = {"oneshot": get_content, "multishot": get_multipart_content}[strategy]
         print(f"Requesting completion for: {cache_key_prefix}")
         content = content_getter(prompt, **kwargs)
         print(f"Received completion for: {cache_key_prefix}")
-        cache_file_path.write_text(content)
+        with tempfile.NamedTemporaryFile(dir=cache_path, delete=False, suffix=".tmp") as temp_cache_file:  # Note: A unique temporary file is used per write so that concurrent writers do not share it.
+            temp_cache_file_path = Path(temp_cache_file.name)
+        try:
+            temp_cache_file_path.write_bytes(content.encode("utf-8"))
+            os.replace(temp_cache_file_path, cache_file_path)  # Note: The file is written atomically so that a partially written file is never read from the cache.
+        except BaseException:
+            temp_cache_file_path.unlink(missing_ok=True)  # Note: The temporary file is removed so that it is not left behind in the cache directory.
+            raise
+        _evict_memory_cached_content(cache_file_path)
 
     assert content == content.rstrip()
     return content
@@ -191,10 +333,26 @@ def write_speech_audio(text: str, path: Path, *, voice: str = "default", client:
     voice_str = voice if (voice == mapped_voice) else f"{voice} ({mapped_voice})"
 
     print(f"Requesting speech audio in {voice_str} voice for: {path.stem}")
-    response = client.audio.speech.create(model=MODELS["tts"], voice=mapped_voice, input=text)
     # relative_path = path.relative_to(Path.cwd())
     # print(f"Writing speech to: {relative_path}")
-    response.stream_to_file(path)
+    try:
+        with client.audio.speech.with_streaming_response.create(model=MODELS["tts"], voice=mapped_voice, input=text) as response, path.open("wb", buffering=FILE_WRITE_BUFFER_SIZE) as file:
+            content_length = int(response.headers.get("content-length", 0))
+            if (content_length > 0) and hasattr(os, "posix_fallocate"):  # Note: posix_fallocate is unavailable on some platforms, e.g. Windows and macOS.
+                try:
+                    os.posix_fallocate(file.fileno(), 0, content_length)  # Note: Preallocation of the file in one step avoids its incremental allocation by the filesystem during streaming.
+                except OSError:  # Note: The preallocation is only an optimization, and it can be unsupported, e.g. by the filesystem.
+                    pass
+            for chunk in response.iter_bytes(chunk_size=STREAM_CHUNK_SIZE):
+                file.write(chunk)
+            file.truncate()  # Note: This removes any preallocated bytes beyond those written, as the decoded content can differ in length from the content length.
+            if FSYNC:  # Note: The file is otherwise not synced, as it can be regenerated if lost, and the OS page cache is left to persist it.
+                file.flush()
+                os.fsync(file.fileno())
+            # Note: The audio is streamed to the file in chunks, thereby not requiring the full audio to be held in memory.
+    except BaseException:
+        path.unlink(missing_ok=True)  # Note: A partially written file is removed so that it is not subsequently mistaken as being complete.
+        raise
     assert path.exists(), path
     # print(f"Wrote speech to: {relative_path}")
     print(f"Received speech audio in {voice_str} voice for: {path.stem}")